@@ -8,6 +8,43 @@ from collections import namedtuple
 
 Time = namedtuple('Time', ['upper', 'lower', 'hyphen'])
 
+_PITCH_ATOM = r"[#$%]?[0-7a-zA-Z][',]*"
+_PITCH_RE = re.compile(r"([#$%]?)([0-7a-zA-Z])([',]*)")
+_PITCH_LIST_RE = re.compile('({})'.format(_PITCH_ATOM))
+_NOTE_RE = re.compile(r"(?P<tie0>~?)(?:(?P<single>{0})|\[(?P<chord>(?:{0})+)\])"
+                      r"(?:(?P<underlines>[_=]+)|(?P<dashes>-*))(?P<dots>\.*)(?P<triplet>/3)?(?P<tie1>~?)"
+                      .format(_PITCH_ATOM))
+_KEY_DIGIT_RE = re.compile(r'\d')
+
+_KEY_DICT = dict(zip('ABCDEFG', [6, 7, 1, 2, 3, 4, 5]))
+# pitch name -> (name, octave shift) in <key> solfa
+_SOLFA_NAME_DICT = {c: (n, shift)
+                    for names, shift in [('1234567', 0), ('qwertyu', 1), ('zxcvbnm', -1)]
+                    for n, c in enumerate(names, 1)}
+# pitch name -> name in C major, for the other keys
+_NAME_DICT = dict(zip('1234567', range(1, 8)))
+_NAME_DICT.update(_KEY_DICT)
+_NAME_DICT.update((c.lower(), n) for c, n in _KEY_DICT.items())
+_ACC_DICT = {'': None, '#': 1, '$': -1, '%': 0}
+
+_TIKZ_PREAMBLE = r"""\tikzstyle{every node}=[inner sep=0pt]
+\tikzstyle{dot}=[circle,fill=white,inner sep=0pt,text width=1.5pt]
+\tikzstyle{lyrics}=[node distance=15pt]
+\tikzstyle{tie}=[line width=0.5pt,bend left=45,min distance=4pt,max distance=5pt]
+\tikzstyle{underline}=[line width=0.5pt]
+\tikzstyle{tie0}=[line width=0.5pt,out=50,in=180,max distance=20pt]
+\tikzstyle{tie1}=[line width=0.5pt,out=130,in=0,max distance=20pt]"""
+_TEX_ACC_DICT = {-1: 'flat', 0: 'natural', 1: 'sharp'}
+_LOWER_DOT_DISTANCE = {-1: 8, -2: 9}     # node.lines -> distance of the lower octave dot
+_LYRICS_HEIGHT_OFFSET = {'每': 1, '悔': 1}   # lyrics char -> extra height (pt)
+
+_LYRICS_STRIP_TABLE = str.maketrans('', '', ' ,.!?' + '　。，、！？')
+
+_F0 = Fraction(0)
+_F1 = Fraction(1)
+_F2_3 = Fraction(2, 3)
+_F3_2 = Fraction(3, 2)
+
 
 class Note:
     """Member variables
@@ -133,7 +170,7 @@ class Note:
                 raise ValueError('unknown time.upper {}'.format(time.upper))
             n_unit, m_unit = 0, time.upper
         else:
-            unit = int(Fraction(3, 2) * (1 << p))
+            unit = int(_F3_2 * (1 << p))
             n, m = p - 1, 3
             if time.upper == 6:
                 n_unit, m_unit = 0, 2
@@ -243,7 +280,7 @@ class Node:
                 if len(one_groups) != 1:
                     raise ValueError('duration {} cannot be represented as a single note'.format(note.duration))
                 m = numerator.bit_length() - 1
-                if duration % Fraction(1) == 0:
+                if duration % _F1 == 0:
                     self.lines = int(duration) - 1
                     self.dots = 0
                 else:
@@ -274,37 +311,29 @@ class Node:
             return ' {}'.format(self.value)
 
 
+# dash and dot nodes carry no per-node state, so a single instance of each is shared
+_DASH_NODE = Node('-')
+_DOT_NODE = Node('.')
+
+
 def parse_pitch(key, s):
-    key_dict = dict(zip('ABCDEFG', [6, 7, 1, 2, 3, 4, 5]))
-    extended_upper_name_dict = dict(zip('qwertyu', range(1, 8)))
-    extended_lower_name_dict = dict(zip('zxcvbnm', range(1, 8)))
-    acc_dict = {'': None, '#': 1, '$': -1, '%': 0}
-    match = re.fullmatch(r"([#$%]?)([0-7a-zA-Z])([',]*)", s)
+    match = _PITCH_RE.fullmatch(s)
     if match is None:
         raise ValueError('wrong format for pitch {}'.format(s))
     acc, name, octave = match.groups()
-    acc = acc_dict[acc]
+    acc = _ACC_DICT[acc]
     octave = octave.count("'") - octave.count(',')
     if name == '0':
         acc, name, octave = None, 0, 0
     elif key == 'solfa':
-        if name in '1234567':
-            name = int(name)
-        elif name in extended_upper_name_dict:
-            name = extended_upper_name_dict[name]
-            octave += 1
-        elif name in extended_lower_name_dict:
-            name = extended_lower_name_dict[name]
-            octave -= 1
-        else:
+        if name not in _SOLFA_NAME_DICT:
             raise ValueError('{!r} is not allowed in <key> solfa'.format(s))
+        name, shift = _SOLFA_NAME_DICT[name]
+        octave += shift
     else:
-        if name in '1234567':
-            name = int(name)
-        elif name in 'cdefgabCDEFGAB':
-            name = key_dict[name.upper()]
-        else:
+        if name not in _NAME_DICT:
             raise ValueError('{!r} is not allowed in key {}'.format(name, key))
+        name = _NAME_DICT[name]
         if acc is not None:
             acc -= key[2][name]         # relative to key
         if key[0] <= 4:                 # <= #F major
@@ -364,37 +393,40 @@ class Song:
         if not s:
             return
 
-        pattern_pitch = r"[#$%]?[0-7a-zA-Z][',]*"
-        pattern_pitches = r'\[(?:{})+\]'.format(pattern_pitch)
-        pattern_duration = r'(?:[_=]+|-*)\.*(?:/3)?'
-        pattern = '(~?)' + '({}|{})({})'.format(pattern_pitch, pattern_pitches, pattern_duration) + '(~?)'
+        if time.upper is None:
+            time_duration = None            # given by each bar
+        elif time.lower == 4:
+            time_duration = Fraction(time.upper)
+        else:
+            time_duration = Fraction(time.upper, 2)
 
         bars = s.split('|')
         for i, bar in enumerate(bars):
             if not bar:
                 continue
 
-            bar_duration = Fraction(0)
+            bar_duration = _F0
             note_list = []
 
             # parse notes in bar
-            notes = re.findall(pattern, bar)
-            if ''.join([''.join(note) for note in notes]) != bar:
+            matches = list(_NOTE_RE.finditer(bar))
+            notes = [match[0] for match in matches]
+            if sum(map(len, notes)) != len(bar):    # matches must cover the bar
                 raise ValueError('wrong format for {} (notes = {})'.format(bar, notes))
-            for tie0, pitches, duration, tie1 in notes:
-                tie0, tie1 = (tie0 != ''), (tie1 != '')
-                dots = duration.count('.')
-                dashes = duration.count('-')
-                underlines = duration.count('=') * 2 + duration.count('_')
+            for match in matches:
+                tie0, tie1 = (match['tie0'] != ''), (match['tie1'] != '')
+                dots = len(match['dots'])
+                dashes = len(match['dashes'] or '')
+                underlines = match['underlines'] or ''
+                underlines = len(underlines) + underlines.count('=')      # '=' counts as two
                 if dashes > 0 and underlines > 0:
-                    raise ValueError('wrong format for {}'.format(notes))
-                triplet = Fraction(1)
-                if '/3' in duration:
-                    triplet = Fraction(2, 3)
+                    raise ValueError('wrong format for {}'.format(match[0]))
+                triplet = _F2_3 if match['triplet'] else _F1
+                chord = match['chord']
                 if time.lower:
-                    if pitches.startswith('[') and pitches.endswith(']'):
-                        duration = (Fraction(dashes + 1, 1 << underlines)
-                                    * (Fraction(2) - Fraction(1, 1 << dots)) * triplet)
+                    if chord is not None:
+                        # (dashes + 1) / 2**underlines * (2 - 1 / 2**dots)
+                        duration = Fraction((dashes + 1) * ((2 << dots) - 1), 1 << (underlines + dots)) * triplet
                     else:
                         if dots or underlines or (triplet != 1):
                             raise ValueError('dots, underlines and triplets are not allowed'
@@ -403,20 +435,18 @@ class Song:
                         duration = Fraction(dashes + 1, time.hyphen // 4)
                         dashes, underlines, dots = None, None, None
                 else:
-                    duration = (Fraction(dashes + 1, 1 << underlines)
-                                * (Fraction(2) - Fraction(1, 1 << dots)) * triplet)
-                pitches = pitches.lstrip('[').rstrip(']')
-                pitches = re.findall('({})'.format(pattern_pitch), pitches)
+                    duration = Fraction((dashes + 1) * ((2 << dots) - 1), 1 << (underlines + dots)) * triplet
+                if chord is None:
+                    pitches = [match['single']]
+                else:
+                    pitches = _PITCH_LIST_RE.findall(chord)
 
+                last = len(pitches) - 1
                 for k, pitch in enumerate(pitches):
                     acc, name, octave = parse_pitch(self.key, pitch)
-                    tie = [tie0, tie1]
-                    if k > 0:
-                        tie[0] = False
-                    if k < len(pitches) - 1:
-                        tie[1] = False
-                    # new Note
-                    note = Note(acc, name, octave, duration, dashes, underlines, dots, tie)
+                    # new Note (only the first and the last pitch keep the ties)
+                    note = Note(acc, name, octave, duration, dashes, underlines, dots,
+                                (tie0 and k == 0, tie1 and k == last))
                     note_list.append(note)
                     bar_duration += duration
             assert note_list
@@ -424,18 +454,22 @@ class Song:
             # append to self.melody
             if time.upper is None:
                 time_duration = bar_duration
-            elif time.lower == 4:
-                time_duration = Fraction(time.upper)
-            else:
-                time_duration = Fraction(time.upper, 2)
             if i == 0 and len(bars) > 1:        # first bar but not last
                 beat = (time_duration - (bar_duration % time_duration)) % time_duration
             else:
-                beat = Fraction(0)
+                beat = _F0
             if beat > 0:
                 self.melody.append((time, beat, []))            # new bar
             for note in note_list:
                 assert note.duration > 0
+                if beat + note.duration <= time_duration:     # fits in the current bar, no need to split
+                    if beat == 0:
+                        self.melody.append((time, beat, []))    # new bar
+                    self.melody[-1][-1].append(note)
+                    beat += note.duration
+                    if beat == time_duration:
+                        beat = 0
+                    continue
                 remaining_duration = note.duration
                 first = True
                 while remaining_duration > 0:
@@ -457,41 +491,37 @@ class Song:
                         beat = 0
                     first = False
 
-    def make_ties_consistent(self):
-        """If note0 and note1 are consecutive, make sure that (note0.tie[1] == note1.tie[0])."""
+    def finalize_melody(self):
+        """Make ties consistent and try to split notes, modifying self.melody in place in a single pass.
+
+        If note0 and note1 are consecutive, make sure that (note0.tie[1] == note1.tie[0]).
+        If note.lines or note.dots is None, splitting is necessary.
+        For these sub-notes, perform a 2nd-staged grouping.
+        """
         if not self.melody:
             return
         prev_tie = False
         for time, start_beat, notes in self.melody:
             if not notes:
                 raise ValueError('empty bar in self.melody')
+            subnotes = []
+            beat = start_beat
             for note in notes:
+                # ties
                 if prev_tie:
                     note.tie[0] = True
                 if note.name == 0:
                     note.tie = [False, False]
                 prev_tie = note.tie[1]
-        self.melody[0][-1][0].tie[0] = False    # first note
-        self.melody[-1][-1][-1].tie[1] = False  # last note
-
-    def try_split_notes(self):
-        """Try to split note, and modify self.melody in place.
-
-        If note.lines or note.dots is None, splitting is necessary.
-        For these sub-notes, perform a 2nd-staged grouping.
-        """
-        for time, start_beat, notes in self.melody:
-            if not time.hyphen:
-                continue
-            subnotes = []
-            beat = start_beat
-            for note in notes:
-                if note.lines is None or note.dots is None:
+                # split
+                if time.hyphen and (note.lines is None or note.dots is None):
                     subnotes += Note.split_note(time, beat, note)
                 else:
                     subnotes.append(note)
                 beat += note.duration
             notes[:] = subnotes
+        self.melody[0][-1][0].tie[0] = False    # first note
+        self.melody[-1][-1][-1].tie[1] = False  # last note
 
     def merge_melody_lyrics(self, _debug=False):
         """Return a list of sections.
@@ -503,19 +533,21 @@ class Song:
         """
         debug_log = []
 
-        # calculate split indices according to self.lyrics
+        # calculate split indices according to self.lyrics, and concatenate all lyrics
         sum_len = 0
         split_sections = {}
-        split_lines = []
-        for i, (tag, lyrics) in enumerate(self.lyrics):
+        split_lines = set()
+        lyrics_parts = []
+        for tag, lyrics in self.lyrics:
             split_sections[sum_len] = tag
-            for j, s in enumerate(lyrics):
+            for s in lyrics:
                 if s.startswith('~'):
                     raise ValueError("a line of lyrics cannot start with '~' ({})".format(s))
-                split_lines.append(sum_len)
+                split_lines.add(sum_len)
+                lyrics_parts.append(s)
                 sum_len += len(s)
-        all_lyrics = ''.join([''.join(section[1]) for section in self.lyrics])
-        num_words = len(all_lyrics)     # contains '~'
+        all_lyrics = ''.join(lyrics_parts)
+        num_words = sum_len     # contains '~'
 
         # calculate the starting and ending index of slurs
         slur_lyrics_idx = {}
@@ -533,6 +565,7 @@ class Song:
         section_added, line_added = False, False    # whether these are added for this lyrics_idx
         line_node_idx_prev = -1
         sections = []
+        nodes = bars = ties = slurs = None      # of the current line
         for time, start_beat, notes in self.melody:
             if time.upper is None:
                 time_duration = None
@@ -552,11 +585,11 @@ class Song:
                     if sections[-1][1] and note.name == 0 and (beat + note.duration) % time_duration == 0:
                         pass
                     else:
-                        sections[-1][1].append([[], [], [], []])    # (nodes, bars, ties, slurs)
+                        line = [[], [], [], []]                     # (nodes, bars, ties, slurs)
+                        sections[-1][1].append(line)
+                        nodes, bars, ties, slurs = line
                         line_added = True
                         line_node_idx_prev = -1
-                line = sections[-1][1][-1]
-                nodes, bars, ties, slurs = line
                 # new bar
                 if k == 0 or not bars:
                     bars.append((time, beat, []))
@@ -581,11 +614,11 @@ class Song:
                 # append dash Node's
                 for _ in range(node.lines):
                     bars[-1][-1].append(len(nodes))
-                    nodes.append(Node('-'))
+                    nodes.append(_DASH_NODE)
                 # append dot Node's
                 for _ in range(node.dots):
                     bars[-1][-1].append(len(nodes))
-                    nodes.append(Node('.'))
+                    nodes.append(_DOT_NODE)
                 beat += note.duration
         if lyrics_idx != num_words:
             raise ValueError('{} notes != {} words'.format(lyrics_idx, num_words))
@@ -625,8 +658,9 @@ class Song:
                         if node.type != NodeType.NOTE:
                             continue
                         # triplet
-                        if (time.lower == 4 and beat % Fraction(1) == 0) or \
-                           (time.lower == 8 and beat % Fraction(3, 2) == 0):
+                        # beat is a multiple of 1 (X/4) or of 3/2 (X/8)
+                        if (time.lower == 4 and beat.denominator == 1) or \
+                           (time.lower == 8 and beat.denominator <= 2 and beat.numerator % 3 == 0):
                             new_group = True
                             triplet_duration = None
                         else:
@@ -644,7 +678,7 @@ class Song:
                         # underline
                         if node.lines < 0:
                             depth = -node.lines        # number of underlines
-                            for _ in range(depth - len(underlines_list) + 1):
+                            while depth >= len(underlines_list):
                                 underlines_list.append([])
                             for k in range(1, depth + 1):
                                 if new_group or not underlines_list[k]:
@@ -658,160 +692,164 @@ class Song:
                 line.append(underlines_list)
                 line.append(triplets)
 
+    @classmethod
+    def calc_line_layout(cls, nodes, bars):
+        """Return (node_pos, bar_pos, width) of a line.
+
+        node_pos[idx]: x position (pt) of nodes[idx]
+        bar_pos[k]: x position (pt) of the bar line before bars[k + 1]
+        width: final x position
+        """
+        node_pos = [None] * len(nodes)
+        bar_pos = []
+        pos = 0
+        for k, (time, start_beat, idx_list) in enumerate(bars):
+            if k > 0:
+                pos -= 2.5
+                bar_pos.append(pos)
+                pos += 7.5
+            for idx in idx_list:
+                if nodes[idx].type == NodeType.NOTE:
+                    node_pos[idx] = pos
+                    pos += 10
+                else:
+                    pos -= 2.5
+                    node_pos[idx] = pos
+                    pos += 7.5
+        return node_pos, bar_pos, pos
+
+    @classmethod
+    def line_to_tex_tikzpicture(cls, line, line_file):
+        """Write environment tikzpicture source code of a line to line_file, and return the lyrics of the line."""
+        nodes, bars, ties, slurs, underlines_list, triplets = line
+        lyrics_chars = []
+        line_output = []
+        append = line_output.append
+        node_pos, bar_pos, width = cls.calc_line_layout(nodes, bars)
+        assert width > 0
+        append(r'\begin{{tikzpicture}}[xscale={}]'.format(110 / width))
+        append(_TIKZ_PREAMBLE)
+        append('\n\n% nodes')
+        append(r'\node at (0pt, 12pt) {}; % for space adjustment')
+
+        NOTE, DASH, DOT = NodeType.NOTE, NodeType.DASH, NodeType.DOT
+        first_text_idx = None
+        for k, (time, start_beat, idx_list) in enumerate(bars):
+            # new bar
+            if k > 0:
+                append(rf'\node at ({bar_pos[k - 1]}pt,0) {{|}};')
+            for idx in idx_list:
+                node = nodes[idx]
+                note = node.value
+                pos = node_pos[idx]
+                append('')
+                if node.type is not NOTE:
+                    if node.type is DASH:
+                        append(rf'\node at ({pos}pt,-1pt) {{-}};')
+                    elif node.type is DOT:
+                        append(rf'\node[dot] at ({pos}pt,0) {{}};')
+                    continue
+                # name
+                append(rf'\node (a{idx}) at ({pos}pt,0) {{{note.name}}};')
+                # acc
+                if note.acc is not None:
+                    acc = _TEX_ACC_DICT[note.acc]
+                    append(rf'\node at ($(a{idx}.north west)+(-1pt,0)$){{\tiny$\{acc}$}};')
+                # octave
+                if note.octave > 0:
+                    append(rf'\node[dot,above of=a{idx},node distance=6pt] {{}};')
+                elif note.octave < 0:
+                    node_distance = _LOWER_DOT_DISTANCE.get(node.lines, 10 if node.lines <= -3 else 7)
+                    append(rf'\node[dot,below of=a{idx},node distance={node_distance}pt] {{}};')
+                # text
+                height = -17
+                if node.text:
+                    height += _LYRICS_HEIGHT_OFFSET.get(node.text, 0)
+                    text = rf'\phantom{{|}}{node.text}\phantom{{|}}'
+                    if first_text_idx is None:
+                        first_text_idx = idx
+                    append(rf'\node[lyrics] (t{idx}) at ($(a{idx})+(0,{height}pt)$) {{{text}}};')
+                    lyrics_chars.append(node.text)
+                elif first_text_idx is None:
+                    text = r'\phantom{天}'
+                    append(rf'\node[lyrics] (t{idx}) at ($(a{idx})+(0,{height}pt)$) {{{text}}};')
+                    first_text_idx = idx
+
+        # ties
+        append('\n\n% ties')
+        for idx0, idx1 in ties:
+            dis = 2
+            if nodes[idx0].value.octave >= 1:
+                dis = 5
+            append(rf'\draw[tie] (a{idx0}.north) ++(0,{dis}pt) coordinate (tmp)'
+                   rf' to (a{idx1}.north |- tmp);')
+
+        # underlines
+        append('\n\n% underlines')
+        for depth, underlines in enumerate(underlines_list):
+            if depth == 0:
+                continue
+            for idx0, idx1 in underlines:
+                append(rf'\draw[underline] (a{idx0}.south west) ++(0,-{depth * 1.5}pt)'
+                       rf' coordinate (tmp) to (a{idx1}.south east |- tmp);')
+
+        # triplets
+        append('\n\n% triplets')
+        for triplet in triplets:
+            dis0, dis1 = 2, 9
+            if nodes[triplet[0]].value.octave >= 1 or nodes[triplet[2]].value.octave >= 1:
+                dis0 = 5
+            if nodes[triplet[1]].value.octave >= 1:
+                dis1 = 12
+            append(rf'\node[above of=a{triplet[1]},node distance={dis1}pt] (tri) {{\tiny{{3}}}};')
+            append(rf'\draw[tie0] (a{triplet[0]}.north) +(0,{dis0}pt) to ($(tri.west)+(-1pt,0)$);')
+            append(rf'\draw[tie1] (a{triplet[2]}.north) +(0,{dis0}pt) to ($(tri.east)+(+1pt,0)$);')
+
+        append('')
+        append(r'\end{tikzpicture}')
+        append('')      # trailing newline
+
+        data = '\n'.join(line_output).encode('utf-8')
+        with open(line_file, 'wb') as f:
+            f.write(data)
+        return ''.join(lyrics_chars)
+
     def to_tex_tikzpicture(self, output_dir=''):
         """Write environment tikzpicture source code to file if provided."""
         slides_file = os.path.join(output_dir, 'slides.tex')
-        slides_output = []
-        line_file_format = os.path.join(output_dir, 'line-{}{:02d}.tex')
+        line_name_format = 'line-{}{:02d}.tex'
         page_count = 0
 
         sections = self.merge_melody_lyrics()
         self.group_underlines(sections)
 
-        for i, (tag, lines) in enumerate(sections):
-            # new section
-            line_count = 0
-            for j, (nodes, bars, ties, slurs, underlines_list, triplets) in enumerate(lines):
-                # new page
-                if line_count % 2 == 0:
-                    page_count += 1
-                    if page_count > 1:
-                        slides_output.append('\n')
-                    slides_output.append('%%%%% PAGE {} %%%%%'.format(page_count))
-                    slides_output.append(r'\newpage')
-                    slides_output.append('')
-                    if j == 0:      # first page in section
-                        slides_output.append('% <{}>'.format(tag))
-                        slides_output.append(r'\begin{nmntag}')
-                        slides_output.append(r'\textmd{$<$\hspace{-0pt}' + tag + r'\hspace{-0pt}$>$}')
-                        slides_output.append(r'\end{nmntag}')
-                    else:
-                        slides_output.append(r'\begin{nmnblank}')
-                        slides_output.append(r'\end{nmnblank}')
-
-                # new line
-                line_lyrics = ''
-                line_output = []
-                line_output.append(r'\begin{tikzpicture}')
-                line_output.append(r"""\tikzstyle{every node}=[inner sep=0pt]
-\tikzstyle{dot}=[circle,fill=white,inner sep=0pt,text width=1.5pt]
-\tikzstyle{lyrics}=[node distance=15pt]
-\tikzstyle{tie}=[line width=0.5pt,bend left=45,min distance=4pt,max distance=5pt]
-\tikzstyle{underline}=[line width=0.5pt]
-\tikzstyle{tie0}=[line width=0.5pt,out=50,in=180,max distance=20pt]
-\tikzstyle{tie1}=[line width=0.5pt,out=130,in=0,max distance=20pt]""")
-                line_output.append('\n\n% nodes')
-                line_output.append(r'\node at (0pt, 12pt) {}; % for space adjustment')
-
-                pos = 0
-                first_text_idx = None
-                for k, (time, start_beat, idx_list) in enumerate(bars):
-                    # new bar
-                    if k > 0:
-                        pos -= 2.5
-                        line_output.append(r'\node at ({}pt,0) {{|}};'.format(pos))
-                        pos += 7.5
-                    for idx in idx_list:
-                        node = nodes[idx]
-                        note = node.value
-                        line_output.append('')
-                        if node.type != NodeType.NOTE:
-                            pos -= 2.5
-                            if node.type == NodeType.DASH:
-                                line_output.append(r'\node at ({}pt,-1pt) {{-}};'.format(pos))
-                            elif node.type == NodeType.DOT:
-                                line_output.append(r'\node[dot] at ({}pt,0) {{}};'.format(pos))
-                            pos += 7.5
-                            continue
-                        # name
-                        line_output.append(r'\node (a{}) at ({}pt,0) {{{}}};'.format(idx, pos, note.name))
-                        # acc
-                        acc_dict = {-1: 'flat', 0: 'natural', 1: 'sharp'}
-                        if note.acc is not None:
-                            line_output.append(r'\node at ($(a{}.north west)+(-1pt,0)$){{\tiny$\{}$}};'
-                                               .format(idx, acc_dict[note.acc]))
-                        # octave
-                        if note.octave > 0:
-                            line_output.append(r'\node[dot,above of=a{},node distance=6pt] {{}};'.format(idx))
-                        elif note.octave < 0:
-                            node_distance = 7
-                            if node.lines <= -3:
-                                node_distance = 10
-                            elif node.lines == -2:
-                                node_distance = 9
-                            elif node.lines == -1:
-                                node_distance = 8
-                            line_output.append(r'\node[dot,below of=a{},node distance={}pt] {{}};'
-                                               .format(idx, node_distance))
-                        # text
-                        height = -17
-                        if node.text:
-                            if node.text in '每悔':
-                                height += 1
-                            text = '{0}{1}{0}'.format('\phantom{|}', node.text)
-                            if first_text_idx is None:
-                                first_text_idx = idx
-                            line_output.append(r'\node[lyrics] (t{0}) at ($(a{0})+(0,{2}pt)$) {{{1}}};'
-                                               .format(idx, text, height))
-                            line_lyrics += node.text
-                        elif first_text_idx is None:
-                            text = r'\phantom{{{}}}'.format('天')
-                            line_output.append(r'\node[lyrics] (t{0}) at ($(a{0})+(0,{2}pt)$) {{{1}}};'
-                                               .format(idx, text, height))
-                            first_text_idx = idx
-                        pos += 10
+        with open(slides_file, 'w', encoding='utf-8') as slides_f:
+            for i, (tag, lines) in enumerate(sections):
+                # new section
+                for j in range(len(lines)):
+                    # new page
+                    if j % 2 == 0:
+                        page_count += 1
+                        if page_count > 1:
+                            print('\n', file=slides_f)
+                        print('%%%%% PAGE {} %%%%%'.format(page_count), r'\newpage', '', sep='\n', file=slides_f)
+                        if j == 0:      # first page in section
+                            print('% <{}>'.format(tag),
+                                  r'\begin{nmntag}',
+                                  r'\textmd{$<$\hspace{-0pt}' + tag + r'\hspace{-0pt}$>$}',
+                                  r'\end{nmntag}',
+                                  sep='\n', file=slides_f)
+                        else:
+                            print(r'\begin{nmnblank}', r'\end{nmnblank}', sep='\n', file=slides_f)
 
-                # ties
-                line_output.append('\n\n% ties')
-                for idx0, idx1 in ties:
-                    dis = 2
-                    if nodes[idx0].value.octave >= 1:
-                        dis = 5
-                    line_output.append(r'\draw[tie] (a{}.north) ++(0,{}pt) coordinate (tmp) to (a{}.north |- tmp);'
-                                       .format(idx0, dis, idx1))
-
-                # underlines
-                line_output.append('\n\n% underlines')
-                for depth, underlines in enumerate(underlines_list):
-                    if depth == 0:
-                        continue
-                    for idx0, idx1 in underlines:
-                        line_output.append(r'\draw[underline] (a{}.south west) ++(0,-{}pt)'.format(idx0, depth * 1.5)
-                                           + r' coordinate (tmp) to (a{}.south east |- tmp);'.format(idx1))
-
-                # triplets
-                line_output.append('\n\n% triplets')
-                for triplet in triplets:
-                    dis0, dis1 = 2, 9
-                    if nodes[triplet[0]].value.octave >= 1 or nodes[triplet[2]].value.octave >= 1:
-                        dis0 = 5
-                    if nodes[triplet[1]].value.octave >= 1:
-                        dis1 = 12
-                    line_output.append(r'\node[above of=a{},node distance={}pt] (tri) {{\tiny{{3}}}};'
-                                       .format(triplet[1], dis1))
-                    line_output.append(r'\draw[tie0] (a{}.north) +(0,{}pt) to ($(tri.west)+(-1pt,0)$);'
-                                       .format(triplet[0], dis0))
-                    line_output.append(r'\draw[tie1] (a{}.north) +(0,{}pt) to ($(tri.east)+(+1pt,0)$);'
-                                       .format(triplet[2], dis0))
-
-                line_output.append('')
-                line_output.append(r'\end{tikzpicture}')
-                line_output.append('')
-                assert line_output[0] == r'\begin{tikzpicture}' and pos > 0
-                line_output[0] = line_output[0] + '[xscale={}]'.format(110 / pos)
-
-                line_file = line_file_format.format(chr(ord('a') + i), j)
-                with open(line_file, 'w', encoding='utf-8') as f:
-                    f.write('\n'.join(line_output))
-                line_count += 1
-
-                slides_output.append('\n% {}'.format(line_lyrics))
-                slides_output.append(r'\begin{nmnline}')
-                slides_output.append(r'\input{{{}}}'.format(line_file.split('/')[-1]))
-                slides_output.append(r'\end{nmnline}')
-
-        with open(slides_file, 'w', encoding='utf8') as f:
-            f.write('\n'.join(slides_output))
+                    # new line
+                    line_name = line_name_format.format(chr(ord('a') + i), j)
+                    line_lyrics = self.line_to_tex_tikzpicture(lines[j], os.path.join(output_dir, line_name))
+                    print('\n% {}'.format(line_lyrics),
+                          r'\begin{nmnline}',
+                          r'\input{{{}}}'.format(line_name),
+                          r'\end{nmnline}',
+                          sep='\n', file=slides_f)
 
     @classmethod
     def print(cls, sections):
@@ -831,17 +869,8 @@ class Song:
                 print('<triplets> {}'.format(triplets))
 
 
-def parse_key(s):
-    """Convert key string to ([1-7], 0 or 1 or -1, list of sharps or flats).
-
-    s = [#$]?[a-gA-G]|[0-7][#$]?
-    For example,
-    s = '$D': D flat major
-    s = '3#': A major
-    key = (2,  0, (?, 1,  0,  0,  1,  0,  0,  0)): D major
-    key = (6, -1, (?, 0, -1, -1,  0,  0, -1, -1)): A flat major
-    """
-    # construct table
+def build_key_tables():
+    """Return (sym2key, key2sym) mapping between key signatures and keys."""
     flat = [0, 7, 3, 6, 2, 5, 1, 4]
     sharp = [0, 4, 1, 5, 2, 6, 3, 7]
     sym2key = {}
@@ -861,13 +890,27 @@ def parse_key(s):
                 a[sharp[n]] = 1
             sym2key[(n, x)] = (key, tmp, tuple(a))
             key2sym[(key, tmp)] = (n, x, tuple(a))
+    return sym2key, key2sym
+
+
+_SYM2KEY, _KEY2SYM = build_key_tables()
 
-    # parse
+
+def parse_key(s):
+    """Convert key string to ([1-7], 0 or 1 or -1, list of sharps or flats).
+
+    s = [#$]?[a-gA-G]|[0-7][#$]?
+    For example,
+    s = '$D': D flat major
+    s = '3#': A major
+    key = (2,  0, (?, 1,  0,  0,  1,  0,  0,  0)): D major
+    key = (6, -1, (?, 0, -1, -1,  0,  0, -1, -1)): A flat major
+    """
     if not s:
         raise ValueError('empty key')
     elif s == 'solfa':
         return s
-    if re.search(r'\d', s):     # s contains digits
+    if _KEY_DIGIT_RE.search(s):     # s contains digits
         if len(s) == 1:
             if s[0] != '0':
                 raise ValueError('wrong format for <key> {}'.format(s))
@@ -878,13 +921,12 @@ def parse_key(s):
             x = 1
         else:
             x = -1
-        return sym2key[(int(s[0]), x)]
+        return _SYM2KEY[(int(s[0]), x)]
     else:
         key = s[-1].upper()
-        key_dict = dict(zip('ABCDEFG', [6, 7, 1, 2, 3, 4, 5]))
-        if key not in key_dict:
+        if key not in _KEY_DICT:
             raise ValueError('wrong format for <key> {}'.format(s))
-        key = key_dict[key]
+        key = _KEY_DICT[key]
         tmp = 0
         if len(s) == 2:
             if s[0] == '#':
@@ -893,7 +935,7 @@ def parse_key(s):
                 tmp = -1
             else:
                 raise ValueError('wrong format for <key> {}'.format(s))
-        return key, tmp, key2sym[(key, tmp)][2]
+        return key, tmp, _KEY2SYM[(key, tmp)][2]
 
 
 def parse_time(s):
@@ -931,7 +973,7 @@ def load_song(melody_file, lyrics_file=None):
     # melody
     with open(melody_file) as f:
         time = None
-        s = ''
+        s_parts = []
         for line in f:
             line = line.strip()
             if line == 'break':
@@ -944,22 +986,19 @@ def load_song(melody_file, lyrics_file=None):
                 song.key = parse_key(line[5:].strip())
             elif line.startswith('<time>'):
                 if time:
-                    song.append_time_signature(time, s)
+                    song.append_time_signature(time, ''.join(s_parts))
                 time = parse_time(line[6:].strip())
-                s = ''
+                s_parts = []
             else:
-                s += line.replace(' ', '')
-        song.append_time_signature(time, s)
-    song.make_ties_consistent()
-    song.try_split_notes()
+                s_parts.append(line.replace(' ', ''))
+        song.append_time_signature(time, ''.join(s_parts))
+    song.finalize_melody()
 
     # lyrics
     with open(lyrics_file, encoding='utf-8') as f:
         for line in f:
             line = line.strip()
-            s = line
-            for c in ' ,.!?' + '　。，、！？':
-                s = s.replace(c, '')
+            s = line.translate(_LYRICS_STRIP_TABLE)
             if s == 'break':
                 break
             elif not s or s.startswith('//'):
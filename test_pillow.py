@@ -1,5 +1,6 @@
 import os
-from math import pi as PI, sin, cos, asin
+from functools import lru_cache
+from math import pi as PI, asin
 from pathlib import Path
 
 import numpy as np
@@ -7,135 +8,158 @@ from PIL import Image, ImageFont, ImageDraw
 import cv2
 
 
-font_path = Path('latex/fonts').resolve()
+font_path = Path(__file__).parent / 'latex' / 'fonts'
 text_font_file = font_path / 'kaiu.ttf'
 en_font_file = font_path / 'times.ttf'
 enbd_font_file = font_path / 'timesbd.ttf'
 enbi_font_file = font_path / 'timesbi.ttf'
 eni_font_file = font_path / 'timesi.ttf'
 
+_Y_OFFSET_CHARS = frozenset('每悔')      # tokens drawn slightly lower
 
-def test_pillow():
-    image = Image.new('RGB', [1500, 1125], color=(0, 100, 100))
-    draw = ImageDraw.Draw(image)
 
-    # fonts
-    font_size = 120
-    tag_font = ImageFont.truetype(str(text_font_file), 80)
-    text_font = ImageFont.truetype(str(text_font_file), font_size)
-    en_font = ImageFont.truetype(str(en_font_file), font_size)
-    enbd_font = ImageFont.truetype(str(enbd_font_file), font_size)
-    enbi_font = ImageFont.truetype(str(enbi_font_file), font_size)
-    eni_font = ImageFont.truetype(str(eni_font_file), font_size)
+@lru_cache(maxsize=None)
+def get_font(font_file, size):
+    """Return the font of ``font_file`` in ``size``, loaded only once."""
+    return ImageFont.truetype(str(font_file), size)
 
-    # tag
-    draw.text((80, 50), '<主歌>', font=tag_font)
 
-    def draw_token(draw, x, y, text, font):
-        """Draw token given the center coordinate."""
-        token_size = draw.textsize(text, font=font)
-        if text in '每悔':
-            y_offset = token_size[1] * 0.05
-        else:
-            y_offset = 0
-        draw.text((x - token_size[0] / 2, y - token_size[1] / 2 + y_offset), text, font=font)
+@lru_cache(maxsize=512)
+def get_glyph(text, font):
+    """Return the rendered mask, size, y offset and mask origin of ``text`` in ``font``, cached for repeated tokens.
 
-    def draw_melody(draw, x, y, text):
-        draw_token(draw, x, y, text, font=enbd_font)
+    The size is measured from the text origin, as draw.textsize did. The mask also keeps any ink left of or above the
+    origin, and its origin is the offset at which it must be drawn relative to the text position.
+    """
+    left, top, right, bottom = font.getbbox(text)
+    size = (right, bottom)
+    origin = (min(left, 0), min(top, 0))
+    mask = Image.new('L', (right - origin[0], bottom - origin[1]))
+    ImageDraw.Draw(mask).text((-origin[0], -origin[1]), text, font=font, fill=255)
+    y_offset = size[1] * 0.05 if text in _Y_OFFSET_CHARS else 0
+    return mask, size, y_offset, origin
 
-    def draw_lyrics(draw, x, y, text):
-        draw_token(draw, x, y, text, font=text_font)
 
-    def draw_circle(draw, x, y, r):
-        draw.ellipse(((x - r, y - r), (x + r, y + r)), fill=(255, 255, 255))
+@lru_cache(maxsize=None)
+def get_sharp_image():
+    """Return the sharp sign resized for the page, loaded only once."""
+    return Image.open(Path(__file__).parent / 'figure' / 'sharp.png').convert('RGBA').resize((40, 40))
 
-    def draw_arc_bad(draw, bbox, start, end, fill, width=1, segments=100):
-        """Draw arc with line width specified."""
-        if len(bbox) == 2:
-            bbox = (bbox[0][0], bbox[0][1], bbox[1][0], bbox[1][1])
 
-        # radians
-        start *= PI / 180
-        end *= PI / 180
+def arc_points(cx, cy, rx, ry, start, end, segments):
+    """Return end points of the tangent segments approximating an arc.
 
-        # angle step
-        da = (end - start) / segments
+    The result is a (..., 2 * segments, 2) array. Angles are in radians. The arc parameters may be arrays, in which
+    case all arcs are computed at once and the leading dimensions of the result follow their broadcast shape. Each
+    trigonometric function is evaluated once over all segment centres.
+    """
+    shape = np.broadcast(cx, cy, rx, ry, start, end).shape
+    cx, cy, rx, ry, start, end = (np.asarray(v, dtype=float)[..., None] for v in (cx, cy, rx, ry, start, end))
 
-        # shift end points with half a segment angle
-        start -= da / 2
-        end -= da / 2
+    # angle step
+    da = (end - start) / segments
 
-        # ellipse radii
-        rx = (bbox[2] - bbox[0]) / 2
-        ry = (bbox[3] - bbox[1]) / 2
+    # shift end points with half a segment angle
+    start = start - da / 2
 
-        # box centre
-        cx = bbox[0] + rx
-        cy = bbox[1] + ry
+    # segment length
+    l = (rx + ry) * da / 2.0
 
-        # segment length
-        l = (rx + ry) * da / 2.0
+    # angle centres
+    a = start + (np.arange(segments) + 0.5) * da
+    sin_a = np.sin(a)
+    cos_a = np.cos(a)
 
-        for i in range(segments):
+    # x,y centres
+    x = cx + cos_a * rx
+    y = cy + sin_a * ry
 
-            # angle centre
-            a = start + (i + 0.5) * da
+    # derivatives
+    dx = -sin_a * rx / (rx + ry)
+    dy = cos_a * ry / (rx + ry)
 
-            # x,y centre
-            x = cx + cos(a) * rx
-            y = cy + sin(a) * ry
+    # segment end points, interleaved as (p1, p2) pairs
+    p1 = np.stack([x - dx * l, y - dy * l], axis=-1)
+    p2 = np.stack([x + dx * l, y + dy * l], axis=-1)
+    return np.stack([p1, p2], axis=-2).reshape(shape + (-1, 2))
 
-            # derivatives
-            dx = -sin(a) * rx / (rx + ry)
-            dy = cos(a) * ry / (rx + ry)
 
-            draw.line([(x - dx * l, y - dy * l), (x + dx * l, y + dy * l)], fill=fill, width=width)
+def test_pillow():
+    image = Image.new('RGB', [1500, 1125], color=(0, 100, 100))
+    draw = ImageDraw.Draw(image)
 
-    def draw_tie_bad(draw, x1, x2, y, h):
-        """Draw tie or slur from ``(x1, y)`` to ``(x2, y)`` with height ``h``."""
-        d = x2 - x1
-        r = (h * h + d * d / 4) / (h * 2)
-        assert r > 0
-        angle = asin(d / r / 2) * (180 / PI)
-        x_c = (x1 + x2) / 2
-        y_c = y - h + r
-        draw_arc_bad(draw, ((x_c - r, y_c - r), (x_c + r, y_c + r)),
-                 270 - angle, 270 + angle, fill=(255, 255, 255), width=6, segments=10)
+    # fonts
+    font_size = 120
+    tag_font = get_font(text_font_file, 80)
+    text_font = get_font(text_font_file, font_size)
+    en_font = get_font(en_font_file, font_size)
+    enbd_font = get_font(enbd_font_file, font_size)
+    enbi_font = get_font(enbi_font_file, font_size)
+    eni_font = get_font(eni_font_file, font_size)
+
+    # tag
+    draw.text((80, 50), '<主歌>', font=tag_font)
+
+    def draw_token(draw, x, y, text, font, fill=(255, 255, 255)):
+        """Draw token given the center coordinate."""
+        mask, token_size, y_offset, origin = get_glyph(text, font)
+        x0 = x - token_size[0] / 2 + origin[0]
+        y0 = y - token_size[1] / 2 + y_offset + origin[1]
+        draw.bitmap((x0, y0), mask, fill=fill)
+
+    def draw_melody(draw, x, y, text, fill=(255, 255, 255)):
+        draw_token(draw, x, y, text, font=enbd_font, fill=fill)
+
+    def draw_lyrics(draw, x, y, text, fill=(255, 255, 255)):
+        draw_token(draw, x, y, text, font=text_font, fill=fill)
 
-    def draw_tie(image, x1, x2, y, h, color=(255, 255, 255)):
-        # convert
-        img = np.array(np.asarray(image)[:, :, ::-1])
+    def draw_circle(draw, x, y, r, fill=(255, 255, 255)):
+        draw.ellipse(((x - r, y - r), (x + r, y + r)), fill=fill)
 
-        # draw tie
+    def draw_ties_bad(draw, ties):
+        """Draw ties or slurs ``(x1, x2, y, h)`` from ``(x1, y)`` to ``(x2, y)`` with height ``h``.
+
+        The arcs of all ties are computed by a single arc_points call.
+        """
+        x1, x2, y, h = np.array(ties, dtype=float).T
         d = x2 - x1
         r = (h * h + d * d / 4) / (h * 2)
-        assert r > 0
-        angle = asin(d / r / 2) * (180 / PI)
+        assert (r > 0).all()
+        angle = np.arcsin(d / r / 2)
         x_c = (x1 + x2) / 2
         y_c = y - h + r
-        270 - angle, 270 + angle
-        cv2.ellipse(img, (int(x_c), int(y_c)), (int(r), int(r)), 0,
-                    270 - angle, 270 + angle, color, thickness=5, lineType=cv2.LINE_AA)
-
-        # convert back
-        image = Image.fromarray(img[:, :, ::-1], 'RGB')
-        draw = ImageDraw.Draw(image)
-        return image, draw
-
-
-    # melody
+        for points in arc_points(x_c, y_c, r, r, 1.5 * PI - angle, 1.5 * PI + angle, 10):
+            draw.line(points.ravel().tolist(), fill=(255, 255, 255), width=6)
+
+    def draw_ties(img, ties, color=(255, 255, 255)):
+        """Draw ties ``(x1, x2, y, h)`` with OpenCV in place on the BGR array ``img``."""
+        for x1, x2, y, h in ties:
+            d = x2 - x1
+            r = (h * h + d * d / 4) / (h * 2)
+            assert r > 0
+            angle = asin(d / r / 2) * (180 / PI)
+            x_c = (x1 + x2) / 2
+            y_c = y - h + r
+            cv2.ellipse(img, (int(x_c), int(y_c)), (int(r), int(r)), 0,
+                        270 - angle, 270 + angle, color[::-1], thickness=5, lineType=cv2.LINE_AA)
+
+
+    # melody, composed on one mask of the staff and pasted onto the page at once
     y_m = 295
-    draw_melody(draw, 155, y_m, '5')
-    draw_melody(draw, 155+150, y_m, '1')
-    draw_melody(draw, 155+300, y_m, '1')
-    draw_melody(draw, 155+450, y_m, '3')
-
-    size_m = draw.textsize('5', font=enbd_font)     # (60, 108)
-    draw.line(((155 - size_m[0] / 2, y_m + size_m[1] / 2 + 20),
-               (155+150 + size_m[0] / 2, y_m + size_m[1] / 2 + 20)), width=8)
-    draw_circle(draw, 155, y_m + size_m[1] / 2 + 60, 8)
-    image, draw = draw_tie(image, 155, 155 + 150, y_m - size_m[1] / 2, 30)
-    image, draw = draw_tie(image, 155 + 300, 155 + 450, y_m - size_m[1] / 2, 30)
+    staff_y = y_m - 150
+    staff = Image.new('L', (image.width, 300))
+    staff_draw = ImageDraw.Draw(staff)
+    y_s = y_m - staff_y
+    draw_melody(staff_draw, 155, y_s, '5', fill=255)
+    draw_melody(staff_draw, 155+150, y_s, '1', fill=255)
+    draw_melody(staff_draw, 155+300, y_s, '1', fill=255)
+    draw_melody(staff_draw, 155+450, y_s, '3', fill=255)
+
+    size_m = get_glyph('5', enbd_font)[1]
+    staff_draw.line(((155 - size_m[0] / 2, y_s + size_m[1] / 2 + 20),
+                     (155+150 + size_m[0] / 2, y_s + size_m[1] / 2 + 20)), fill=255, width=8)
+    draw_circle(staff_draw, 155, y_s + size_m[1] / 2 + 60, 8, fill=255)
+    image.paste((255, 255, 255), (0, staff_y), mask=staff)
 
 
     # lyrics
@@ -143,15 +167,23 @@ def test_pillow():
     draw_lyrics(draw, 155+150, 500, '個')
     draw_lyrics(draw, 155+300, 500, '狂')
     draw_lyrics(draw, 155+450, 500, '風')
-    sharp_im = Image.open('figure/sharp.png').resize((40, 40))
-    # image.paste(sharp_im, mask=None)  # TODO
+    sharp_im = get_sharp_image()
+    # image.paste(sharp_im, mask=sharp_im)  # TODO
+
+    # PIL drawing is done; convert once and finish the page on the BGR array
+    img = np.array(np.asarray(image)[:, :, ::-1])
+
+    # ties
+    draw_ties(img, [(155, 155 + 150, y_m - size_m[1] / 2, 30),
+                    (155 + 300, 155 + 450, y_m - size_m[1] / 2, 30)])
 
     # save to file
     if os.name == 'nt':
         filename = Path.home() / 'DeskTop' / 'test_pillow.png'
     else:
         filename = Path.home() / 'htdocs' / 'test_pillow.png'
-    image.save(str(filename))
+    if not cv2.imwrite(str(filename), img):
+        raise OSError('cannot write {}'.format(filename))
     print('Save to {}'.format(filename))
 
 